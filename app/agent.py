@@ -1,262 +1,995 @@
+from __future__ import annotations
+
 import os
-import json
+import asyncio
+import atexit
+import functools
+import hashlib
+import io
 import re
-import textwrap
-from typing import Tuple
+from typing import TYPE_CHECKING, AsyncIterator, Iterator, Tuple
 
+import orjson
 import streamlit as st
-import requests
-from bs4 import BeautifulSoup
-from openai import OpenAI
-from langfuse import Langfuse
-
+from aiolimiter import AsyncLimiter
+from diskcache import Cache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+# The HTTP, OpenAI, Langfuse, lxml and tiktoken packages are imported where first used,
+# so the Streamlit UI renders before any of them is loaded.
+if TYPE_CHECKING:
+    import aiohttp
+    import requests
+    import tiktoken
+    from lxml import etree
+    from openai import AsyncOpenAI
 
 # Constants
 OPENAI_API_KEY_ENV = "OPENAI_API_KEY"
 DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Optional: capture model chain-of-thought in Langfuse only (never shown to users)
 CAPTURE_COT = os.getenv("LANGFUSE_CAPTURE_COT", "false").lower() in ("1", "true", "yes", "on")
+# Langfuse exports spans in the background; set to force a blocking flush after each request
+LANGFUSE_ENFORCE_FLUSH = os.getenv("LANGFUSE_ENFORCE_FLUSH", "false").lower() in ("1", "true", "yes", "on")
+# Client-side limits for concurrent OpenAI calls, applied per batch run (each batch gets
+# its own semaphore and limiter; keep below the account's RPM to avoid 429s)
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+# Token budget: scraped content is trimmed to MAX_CONTENT_TOKENS, or less if needed to
+# fit the context window after the prompt scaffolding and the reserved completion tokens
+OPENAI_CONTEXT_TOKENS = int(os.getenv("OPENAI_CONTEXT_TOKENS", "128000"))
+MAX_CONTENT_TOKENS = int(os.getenv("MAX_CONTENT_TOKENS", "3000"))
+MAX_COMPLETION_TOKENS = int(os.getenv("MAX_COMPLETION_TOKENS", "400"))
+# JSON completions carry the reasoning ahead of the answer, so they get a larger cap
+MAX_COT_COMPLETION_TOKENS = int(os.getenv("MAX_COT_COMPLETION_TOKENS", "1200"))
+
+SYSTEM_PROMPT = (
+    "You are a precise web analyst. Use only the provided content. "
+    "If information is missing, say so clearly. Keep answers concise."
+)
+# User prompt templates, formatted with text= and query=
+_COT_TEMPLATE = (
+    "Below is content scraped from a public website.\n\n"
+    "Content:\n{text}\n\n"
+    "User question:\n{query}\n\n"
+    "Return a compact JSON object with keys 'reasoning' and 'answer'. "
+    "Keep 'reasoning' brief and high-level; avoid sensitive data."
+)
+_PLAIN_TEMPLATE = (
+    "Below is content scraped from a public website.\n\n"
+    "Content:\n{text}\n\n"
+    "User question:\n{query}\n\n"
+    "Provide a clear, factual, carefully structured answer."
+)
+# Several questions about one page in a single completion, formatted with text= and questions=
+_COT_BATCH_TEMPLATE = (
+    "Below is content scraped from a public website.\n\n"
+    "Content:\n{text}\n\n"
+    "User questions:\n{questions}\n\n"
+    "Answer each question independently. Return a compact JSON object of the form "
+    '{{"answers": [{{"id": <question number>, "reasoning": "...", "answer": "..."}}]}} '
+    "with one entry per question. Keep each 'reasoning' brief and high-level; avoid sensitive data."
+)
+_PLAIN_BATCH_TEMPLATE = (
+    "Below is content scraped from a public website.\n\n"
+    "Content:\n{text}\n\n"
+    "User questions:\n{questions}\n\n"
+    "Answer each question independently with a clear, factual, carefully structured answer. "
+    'Return a JSON object of the form {{"answers": [{{"id": <question number>, "answer": "..."}}]}} '
+    "with one entry per question."
+)
+# CAPTURE_COT is fixed for the process, so the template and output format are chosen once
+_USER_TEMPLATE = _COT_TEMPLATE if CAPTURE_COT else _PLAIN_TEMPLATE
+_BATCH_TEMPLATE = _COT_BATCH_TEMPLATE if CAPTURE_COT else _PLAIN_BATCH_TEMPLATE
+_RESPONSE_FORMAT = {"response_format": {"type": "json_object"}} if CAPTURE_COT else {}
+_MAX_TOKENS = MAX_COT_COMPLETION_TOKENS if CAPTURE_COT else MAX_COMPLETION_TOKENS
+# Shown instead of a JSON completion that hit the token cap; never cached
+_TRUNCATED_ANSWER = "The answer was cut off before it was complete. Please try a narrower question."
+# Shown instead of summarizing when a page yields no paragraph text (non-HTML or empty)
+_NO_CONTENT_ANSWER = "No readable text was found at this URL; it may not be an HTML page."
+# Shown for a question the batched completion left out; never cached
+_MISSING_ANSWER = "No answer was returned for this question. Please try again."
+_UNCACHED_ANSWERS = frozenset({_TRUNCATED_ANSWER, _MISSING_ANSWER})
+
+_URL_RE = re.compile(r"https?://\S+")
+# Emails and API-key-like tokens, redacted from captured reasoning in a single pass
+_PII_RE = re.compile(
+    r"(?P<email>[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,})"
+    r"|(?P<key>\b(?:sk|pk)-[A-Za-z0-9_\-]+\b)"
+)
+_WS_RE = re.compile(r"\s+")
+_CHARSET_RE = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+# Generous character ceiling for extraction; the token budget does the precise trimming
+MAX_SCRAPE_CHARS = 32000
+# Upper bound on body bytes read per page, whatever the server sends
+MAX_SCRAPE_BYTES = 2_000_000
+_SKIP_TAGS = frozenset({"script", "style", "nav", "footer", "header"})
+
+# Shared HTTP session: keep-alive connections are pooled and reused across scrapes
+_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Connection": "keep-alive",
+}
+
+
+# cache_resource keeps one session (and its pooled sockets) alive for the whole
+# Streamlit server process, even if this module is reloaded.
+@st.cache_resource(show_spinner=False)
+def _http_session() -> requests.Session:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    atexit.register(session.close)
+    return session
+
+# On-disk LRU of scraped pages, url -> (etag, last_modified, text). Kept on disk so
+# it survives server restarts.
+CACHE_DIR = os.getenv("CACHE_DIR", "/tmp/crewai_cache")
+_SCRAPE_CACHE = Cache(
+    os.path.join(CACHE_DIR, "scrape"),
+    size_limit=256 << 20,
+    eviction_policy="least-recently-used",
+)
+# Summaries keyed by (model, capture_cot, content digest, query digest) so repeated
+# (page, question) pairs skip the LLM call
+SUMMARY_CACHE_TTL = 7 * 24 * 60 * 60
+_SUMMARY_CACHE = Cache(os.path.join(CACHE_DIR, "summaries"), size_limit=64 << 20)
+# Whole (url, scraped, summary) results keyed by (url, query, model); short-lived so
+# repeated demo prompts skip both the scrape and the LLM call
+RESPONSE_CACHE_TTL = 60 * 60
+_RESPONSE_CACHE = Cache(os.path.join(CACHE_DIR, "responses"), size_limit=512 << 20)
+
+
+class _ParagraphCollector:
+    """lxml parser target that keeps the text of <p> elements outside noise tags.
+
+    libxml2 streams start/end/data events straight into these callbacks, so
+    the page is read in a single pass and no element tree is ever built.
+    """
+
+    def __init__(self):
+        self._skip_depth = 0
+        self._p_depth = 0
+        self._parts: list[str] = []
+        # Paragraphs are written straight into one buffer, space-separated
+        self._buf = io.StringIO()
+        self.size = 0
+        # Set once MAX_SCRAPE_CHARS is reached; later text would only be truncated away
+        self.full = False
+
+    def start(self, tag, attrib):
+        if tag in _SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == "p" and not self._skip_depth:
+            self._p_depth += 1
+
+    def end(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip_depth -= 1
+        elif tag == "p" and self._p_depth and not self._skip_depth:
+            self._p_depth -= 1
+            if not self._p_depth:
+                paragraph = "".join(self._parts).strip()
+                if paragraph:
+                    if self.size:
+                        self._buf.write(" ")
+                    self._buf.write(paragraph)
+                    self.size += len(paragraph) + 1
+                    self.full = self.size >= MAX_SCRAPE_CHARS
+                self._parts = []
+
+    def data(self, data):
+        if self._p_depth and not self._skip_depth and not self.full:
+            self._parts.append(data)
+
+    def close(self):
+        return self._buf.getvalue()[:MAX_SCRAPE_CHARS]
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding_for(model: str) -> tiktoken.Encoding | None:
+    """The model's tiktoken encoding, or None if its BPE file can't be loaded.
+
+    tiktoken downloads the file on first use unless TIKTOKEN_CACHE_DIR has it
+    (the Docker image bakes it in). A failure is cached too, so an offline
+    host doesn't retry the download on every request.
+    """
+    import tiktoken
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Unknown or newer model name: fall back to the current OpenAI encoding
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as exc:
+        print(f"⚠️ tiktoken encoding unavailable, trimming by characters: {exc}")
+        return None
+
+
+@functools.cache
+def env_api_key() -> str | None:
+    """OPENAI_API_KEY from the environment, read once and shared by all agents."""
+    return os.getenv(OPENAI_API_KEY_ENV)
+
+
+def extract_first_url(text: str) -> str | None:
+    """The first http(s) URL in ``text``, if any."""
+    match = _URL_RE.search(text)
+    return match.group(0) if match else None
+
+
+def _digest(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def _normalize_query(query: str) -> str:
+    """Case and whitespace variants of the same question map to one cache entry."""
+    return _WS_RE.sub(" ", query.strip().lower())
+
+
+def _paragraph_parser(encoding: str | None = None) -> tuple[etree.HTMLParser, _ParagraphCollector]:
+    """Incremental HTML parser feeding a fresh _ParagraphCollector; feed() each chunk, then close()."""
+    from lxml import etree
+
+    collector = _ParagraphCollector()
+    try:
+        parser = etree.HTMLParser(target=collector, encoding=encoding)
+    except LookupError:
+        # A charset label libxml2 doesn't know (e.g. "latin-1"): let it sniff <meta> instead
+        parser = etree.HTMLParser(target=collector)
+    return parser, collector
+
+
+def _close_parser(parser: etree.HTMLParser) -> str:
+    """parser.close(), treating an empty document as no text."""
+    from lxml import etree
+
+    try:
+        return parser.close()
+    except etree.XMLSyntaxError:
+        # libxml2 refuses to close a parser that was never fed, e.g. an empty 200 body
+        return ""
+
 
+def _declared_charset(resp: requests.Response) -> str | None:
+    """Charset from the Content-Type header, if the server sent one (None lets lxml sniff <meta>)."""
+    match = _CHARSET_RE.search(resp.headers.get("Content-Type", ""))
+    return match.group(1) if match else None
 
+
+def _redact(match: re.Match) -> str:
+    return "[REDACTED_EMAIL]" if match.lastgroup == "email" else "[REDACTED_KEY]"
+
+
+def _is_html(content_type: str) -> bool:
+    """False for responses that declare a non-HTML body (PDFs, images, video, ...)."""
+    return not content_type or "html" in content_type.lower()
+
+
+def _is_rate_limit(exc: BaseException) -> bool:
+    from openai import RateLimitError
+
+    return isinstance(exc, RateLimitError)
+
+
+def _cached_page(url: str) -> tuple[dict, str | None]:
+    """Returns (request_headers, cached_text); adds conditional headers when a cached copy exists."""
+    entry = _SCRAPE_CACHE.get(url)
+    if entry is None:
+        return _HEADERS, None
+
+    etag, last_modified, text = entry
+    headers = dict(_HEADERS)
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers, text
+
+
+def _store_page(url: str, resp_headers, text: str) -> None:
+    """Remember the page's validators alongside its extracted text."""
+    _SCRAPE_CACHE.set(url, (resp_headers.get("ETag"), resp_headers.get("Last-Modified"), text))
+
+
+# --------------------- AGENT CLASS ---------------------
 class WebScraperCrewAgent:
     """Scrapes public web pages and summarizes content using OpenAI, logs to Langfuse."""
 
-    def __init__(self, model: str | None = None):
-        api_key = os.getenv(OPENAI_API_KEY_ENV)
+    def __init__(self, model: str | None = None, api_key: str | None = None):
+        api_key = api_key or env_api_key()
         if not api_key:
             raise RuntimeError(f"Missing {OPENAI_API_KEY_ENV}. Set it in environment or sidebar.")
 
+        from langfuse import Langfuse
+        from openai import OpenAI
+
+        # OpenAI setup
+        self.api_key = api_key
         self.client = OpenAI(api_key=api_key)
         self.model = model or DEFAULT_MODEL
 
-        # Initialize Langfuse
+        # Initialize Langfuse (new API)
         try:
+            # The SDK exports spans from a background worker, batching up to LANGFUSE_FLUSH_AT
+            # spans (default 512) or every LANGFUSE_FLUSH_INTERVAL seconds (default 5); it
+            # reads both environment variables itself
             self.langfuse = Langfuse()
             print("✅ Langfuse initialized successfully")
-            self.langfuse.trace(
-                name="startup-test-trace",
-                input="docker container startup",
-                output="langfuse connection verified",
-                tags=["init", "connectivity-check"],
-            )
-            print("✅ Langfuse startup test trace sent")
         except Exception as e:
             print(f"⚠️ Langfuse initialization failed: {e}")
             self.langfuse = None
 
-    def _extract_first_url(self, text: str) -> str | None:
-        urls = re.findall(r"https?://\S+", text)
-        return urls[0] if urls else None
+    def _flush_langfuse(self) -> None:
+        """Block on exporting queued spans only when LANGFUSE_ENFORCE_FLUSH is set.
+
+        Otherwise the SDK's background exporter ships them in batches and
+        flushes whatever is left when the interpreter exits.
+        """
+        if LANGFUSE_ENFORCE_FLUSH:
+            self.langfuse.flush()
 
     def scrape_website(self, url: str, timeout_seconds: int = 15) -> str:
         try:
-            headers = {
-                "User-Agent": (
-                    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
-                    "(KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
-                )
-            }
-            resp = requests.get(url, timeout=timeout_seconds, headers=headers)
-            resp.raise_for_status()
-            soup = BeautifulSoup(resp.text, "html.parser")
-
-            for tag in soup(["script", "style", "nav", "footer", "header"]):
-                tag.decompose()
-
-            paragraphs = [p.get_text(" ").strip() for p in soup.find_all("p")]
-            text = " ".join(p for p in paragraphs if p)
-            return text[:8000]
+            headers, cached_text = _cached_page(url)
+            # Stream the body and stop downloading once enough paragraph text is collected
+            with _http_session().get(url, timeout=timeout_seconds, headers=headers, stream=True) as resp:
+                if resp.status_code == 304 and cached_text is not None:
+                    return cached_text
+                resp.raise_for_status()
+                if not _is_html(resp.headers.get("Content-Type", "")):
+                    return ""
+                parser, collector = _paragraph_parser(_declared_charset(resp))
+                received = 0
+                for chunk in resp.iter_content(chunk_size=16384):
+                    parser.feed(chunk)
+                    received += len(chunk)
+                    if collector.full or received >= MAX_SCRAPE_BYTES:
+                        break
+                text = _close_parser(parser)
+            _store_page(url, resp.headers, text)
+            return text
+        except Exception as exc:
+            return f"Error scraping website: {exc}"
+
+    async def ascrape_website(
+        self, url: str, session: aiohttp.ClientSession, timeout_seconds: int = 15
+    ) -> str:
+        """Async variant of scrape_website using a shared aiohttp session."""
+        import aiohttp
+
+        try:
+            headers, cached_text = _cached_page(url)
+            async with session.get(
+                url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout_seconds)
+            ) as resp:
+                if resp.status == 304 and cached_text is not None:
+                    return cached_text
+                resp.raise_for_status()
+                if not _is_html(resp.headers.get("Content-Type", "")):
+                    return ""
+                parser, collector = _paragraph_parser(resp.charset)
+                received = 0
+                async for chunk in resp.content.iter_chunked(16384):
+                    parser.feed(chunk)
+                    received += len(chunk)
+                    if collector.full or received >= MAX_SCRAPE_BYTES:
+                        break
+                text = _close_parser(parser)
+            _store_page(url, resp.headers, text)
+            return text
         except Exception as exc:
             return f"Error scraping website: {exc}"
 
-    def summarize_content(self, text: str, query: str, trace=None, url: str | None = None) -> str:
-        system_prompt = (
-            "You are a precise web analyst. Use only the provided content. "
-            "If information is missing, say so clearly. Keep answers concise but reasoning rich."
+    def _build_prompts(self, text: str, query: str) -> tuple[str, str]:
+        """Returns (system_prompt, user_prompt) for the summarization call."""
+        return SYSTEM_PROMPT, _USER_TEMPLATE.format(text=text, query=query)
+
+    def _fit_to_budget(self, text: str, query: str) -> tuple[str, int]:
+        """Trim ``text`` to the model's remaining token budget; returns (text, token_count)."""
+        enc = _encoding_for(self.model)
+        if enc is None:
+            # No tokenizer: cap at roughly MAX_CONTENT_TOKENS (~4 characters per token)
+            text = text[: MAX_CONTENT_TOKENS * 4]
+            return text, len(text) // 4
+
+        system_prompt, user_prompt = self._build_prompts("", query)
+        # Scraped pages may contain special-token text such as <|endoftext|>; count it as plain text
+        scaffold = len(enc.encode(system_prompt, disallowed_special=())) + len(
+            enc.encode(user_prompt, disallowed_special=())
         )
+        budget = max(min(MAX_CONTENT_TOKENS, OPENAI_CONTEXT_TOKENS - _MAX_TOKENS - scaffold), 0)
 
-        if CAPTURE_COT:
-            user_prompt = (
-                "Below is content scraped from a public website.\n\n"
-                "Content:\n"
-                f"{text}\n\n"
-                "User question:\n"
-                f"{query}\n\n"
-                "Return a JSON object with the following keys:\n"
-                "  - reasoning: a detailed, step-by-step internal chain-of-thought (several short paragraphs or numbered steps). "
-                "    This is for internal telemetry only and should not be shown to the user. Avoid copying private data.\n"
-                "  - intermediate_steps: an optional structured breakdown of reasoning steps as an array of objects, e.g.:\n"
-                '    [ {"step": 1, "thought": "Identified key topics"}, {"step": 2, "thought": "Summarized events"} ]\n'
-                "  - answer: the concise final answer to present to the user (1–3 short paragraphs).\n\n"
-                "Make 'reasoning' thorough: include the steps you took to interpret the content, how you prioritized facts, "
-                "which parts of the content you used, and any assumptions. Do NOT include credentials or PII.\n"
-                "Return only valid JSON. Keep the object compact but allow substantial detail in 'reasoning'."
-            )
-        else:
-            user_prompt = (
-                f"Below is content scraped from a public website.\n\n"
-                f"Content:\n{text}\n\n"
-                f"User question:\n{query}\n\n"
-                "Provide a clear, factual, carefully structured answer."
-            )
+        tokens = enc.encode(text, disallowed_special=())
+        if len(tokens) > budget:
+            tokens = tokens[:budget]
+            text = enc.decode(tokens)
+        return text, len(tokens)
 
-        def _scrub_sensitive(s: str) -> str:
-            s = re.sub(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}", "[REDACTED_EMAIL]", s)
-            s = re.sub(r"\b(sk|pk)-[A-Za-z0-9_\-]+\b", "[REDACTED_KEY]", s)
-            return s
+    def _summary_key(self, text: str, query: str) -> tuple:
+        # Hash the inputs so cache keys stay small regardless of page size
+        return (self.model, CAPTURE_COT, _digest(text), _digest(_normalize_query(query)))
 
-        def _call_openai_and_parse() -> tuple[str, str | None, list | None]:
-            if CAPTURE_COT:
-                resp = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt},
-                    ],
-                    temperature=0.2,
-                    max_tokens=2000,
-                    response_format={"type": "json_object"},
-                )
-                content = resp.choices[0].message.content or ""
-                try:
-                    obj = json.loads(content)
-                    answer = str(obj.get("answer", ""))
-                    reasoning = obj.get("reasoning")
-                    steps = obj.get("intermediate_steps")
-                    if isinstance(reasoning, str):
-                        reasoning = _scrub_sensitive(reasoning)
-                    return answer, reasoning, steps
-                except Exception:
-                    return content, None, None
-            else:
-                resp = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt},
-                    ],
-                    temperature=0.2,
-                    max_tokens=800,
-                )
-                return resp.choices[0].message.content, None, None
-
-        # --- Langfuse logging ---
-        if self.langfuse and trace is not None:
-            try:
-                gen = trace.generation(
-                    name="summarize_content",
-                    model=self.model,
-                    input={"system": system_prompt, "user": user_prompt},
-                    metadata={"temperature": 0.2, "url": url, "capture_cot": CAPTURE_COT},
-                )
-            except Exception:
-                gen = None
+    def _cached_summary(self, key: tuple, query: str, url: str | None, parent=None) -> str | None:
+        """Returns the cached answer for ``key``, if any.
+
+        A hit is recorded as a plain Langfuse span rather than a generation,
+        so no model call or token usage is reported for it.
+        """
+        answer = _SUMMARY_CACHE.get(key)
+        if answer is not None and self.langfuse:
+            (parent or self.langfuse).start_span(
+                name="summarize_content",
+                input={"query": query},
+                output=answer,
+                metadata={"url": url, "cache_hit": True},
+            ).end()
+        return answer
+
+    def _store_summary(self, key: tuple, answer: str) -> None:
+        if answer not in _UNCACHED_ANSWERS:
+            _SUMMARY_CACHE.set(key, answer, expire=SUMMARY_CACHE_TTL)
+
+    def _completion_kwargs(self, system_prompt: str, user_prompt: str) -> dict:
+        """Arguments for chat.completions.create, shared by the sync and async clients."""
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            "temperature": 0.2,
+            "max_tokens": _MAX_TOKENS,
+            **_RESPONSE_FORMAT,
+        }
+
+    def _parse_completion(self, choice) -> tuple[str, str | None]:
+        """Returns (answer, reasoning_or_none) for a completion choice."""
+        content = choice.message.content
+        if not CAPTURE_COT:
+            return content, None
+        if choice.finish_reason == "length":
+            # Cut off mid-object: the raw JSON leads with internal reasoning, so don't show it
+            return _TRUNCATED_ANSWER, None
+        content = content or ""
+        try:
+            obj = orjson.loads(content)
+            return str(obj.get("answer", "")), obj.get("reasoning")
+        except Exception:
+            # Fallback if JSON parsing fails: treat full content as answer
+            return content, None
+
+    def _log_reasoning(self, reasoning: str | None, parent=None) -> None:
+        """Record redacted reasoning in its own span, under ``parent`` or the current span."""
+        if self.langfuse and CAPTURE_COT and reasoning:
+            # Store reasoning in a dedicated span to avoid mixing with user-visible output
+            (parent or self.langfuse).start_span(
+                name="chain_of_thought",
+                input={"purpose": "internal chain-of-thought"},
+                output={"reasoning": _PII_RE.sub(_redact, reasoning)},
+            ).end()
+
+    @retry(
+        wait=wait_random_exponential(min=1, max=30),
+        stop=stop_after_attempt(5),
+        retry=retry_if_exception(_is_rate_limit),
+        reraise=True,
+    )
+    def _create_completion(self, **kwargs):
+        """chat.completions.create for the single-prompt paths, retried on 429s."""
+        return self.client.chat.completions.create(**kwargs)
 
-            answer, reasoning, steps = _call_openai_and_parse()
+    def summarize_content(self, text: str, query: str, url: str | None = None) -> str:
+        """Summarize content using OpenAI and log the generation to Langfuse.
 
-            if gen is not None:
+        If LANGFUSE_CAPTURE_COT is enabled, requests JSON output with
+        fields {"reasoning", "answer"}. Only "answer" is shown to users;
+        the "reasoning" is recorded in Langfuse under a dedicated span.
+        """
+        key = self._summary_key(text, query)
+        cached = self._cached_summary(key, query, url)
+        if cached is not None:
+            return cached
+
+        system_prompt, user_prompt = self._build_prompts(text, query)
+
+        def _call_openai_and_parse() -> tuple[str, str | None]:
+            """Returns (answer, reasoning_or_none)."""
+            resp = self._create_completion(**self._completion_kwargs(system_prompt, user_prompt))
+            answer, reasoning = self._parse_completion(resp.choices[0])
+            self._store_summary(key, answer)
+            return answer, reasoning
+
+        if self.langfuse:
+            with self.langfuse.start_as_current_generation(
+                name="summarize_content",
+                input={"system": system_prompt, "user": user_prompt},
+                metadata={"url": url, "capture_cot": CAPTURE_COT},
+                model=self.model,
+            ) as gen:
+                answer, reasoning = _call_openai_and_parse()
                 gen.output = answer
+                self._log_reasoning(reasoning)
+                return answer
+        else:
+            answer, _ = _call_openai_and_parse()
+            return answer
+
+    def summarize_stream(
+        self, text: str, query: str, url: str | None = None, parent=None
+    ) -> Iterator[str]:
+        """Yield the answer as it is generated, for st.write_stream.
+
+        Plain answers stream token by token. With LANGFUSE_CAPTURE_COT the JSON
+        object has to be complete before "answer" can be read, so it is yielded
+        once. The Langfuse generation (a child of ``parent`` when given) is
+        closed with the full answer after the last token.
+        """
+        key = self._summary_key(text, query)
+        cached = self._cached_summary(key, query, url, parent=parent)
+        if cached is not None:
+            yield cached
+            return
+
+        system_prompt, user_prompt = self._build_prompts(text, query)
+        kwargs = self._completion_kwargs(system_prompt, user_prompt)
 
-            # Log reasoning (text) and structured steps (JSON array) in separate spans
+        gen = None
+        if self.langfuse:
+            gen = (parent or self.langfuse).start_generation(
+                name="summarize_content",
+                input={"system": system_prompt, "user": user_prompt},
+                metadata={"url": url, "capture_cot": CAPTURE_COT, "stream": not CAPTURE_COT},
+                model=self.model,
+            )
+
+        buffer: list[str] = []
+        try:
             if CAPTURE_COT:
-                if reasoning:
-                    try:
-                        trace.span(name="chain_of_thought").end(output={"reasoning": reasoning})
-                    except Exception:
-                        pass
-                if steps:
-                    try:
-                        trace.span(name="intermediate_steps").end(output={"steps": steps})
-                    except Exception:
-                        pass
+                resp = self._create_completion(**kwargs)
+                answer, reasoning = self._parse_completion(resp.choices[0])
+                self._log_reasoning(reasoning, parent=parent)
+                self._store_summary(key, answer)
+                buffer.append(answer)
+                yield answer
+            else:
+                for chunk in self._create_completion(**kwargs, stream=True):
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        buffer.append(delta)
+                        yield delta
+                self._store_summary(key, "".join(buffer))
+        finally:
+            if gen is not None:
+                gen.update(output="".join(buffer))
+                gen.end()
+
+    @retry(
+        wait=wait_random_exponential(min=1, max=30),
+        stop=stop_after_attempt(5),
+        retry=retry_if_exception(_is_rate_limit),
+        reraise=True,
+    )
+    async def _acreate_completion(
+        self, client: AsyncOpenAI, sem: asyncio.Semaphore, limiter: AsyncLimiter, **kwargs
+    ):
+        """chat.completions.create bounded by the batch semaphore and RPM limiter."""
+        async with sem, limiter:
+            return await client.chat.completions.create(**kwargs)
+
+    async def asummarize_content(
+        self,
+        text: str,
+        query: str,
+        client: AsyncOpenAI,
+        sem: asyncio.Semaphore,
+        limiter: AsyncLimiter,
+        url: str | None = None,
+    ) -> str:
+        """Async variant of summarize_content using a shared AsyncOpenAI client."""
+        key = self._summary_key(text, query)
+        cached = self._cached_summary(key, query, url)
+        if cached is not None:
+            return cached
+
+        system_prompt, user_prompt = self._build_prompts(text, query)
+
+        async def _call_openai_and_parse() -> tuple[str, str | None]:
+            resp = await self._acreate_completion(
+                client, sem, limiter, **self._completion_kwargs(system_prompt, user_prompt)
+            )
+            answer, reasoning = self._parse_completion(resp.choices[0])
+            self._store_summary(key, answer)
+            return answer, reasoning
 
-            return answer
+        if self.langfuse:
+            with self.langfuse.start_as_current_generation(
+                name="summarize_content",
+                input={"system": system_prompt, "user": user_prompt},
+                metadata={"url": url, "capture_cot": CAPTURE_COT},
+                model=self.model,
+            ) as gen:
+                answer, reasoning = await _call_openai_and_parse()
+                gen.output = answer
+                self._log_reasoning(reasoning)
+                return answer
         else:
-            answer, _, _ = _call_openai_and_parse()
+            answer, _ = await _call_openai_and_parse()
             return answer
 
+    def _parse_batch(self, choice, count: int) -> tuple[list[str], list[str]]:
+        """Returns (answers, reasonings) for a batched completion of ``count`` questions."""
+        if choice.finish_reason == "length":
+            return [_TRUNCATED_ANSWER] * count, []
+        try:
+            items = orjson.loads(choice.message.content or "").get("answers", [])
+            by_id = {int(item["id"]): item for item in items}
+        except Exception:
+            by_id = {}
+        answers, reasonings = [], []
+        for n in range(1, count + 1):
+            item = by_id.get(n, {})
+            answers.append(str(item.get("answer") or _MISSING_ANSWER))
+            if item.get("reasoning"):
+                reasonings.append(f"{n}. {item['reasoning']}")
+        return answers, reasonings
+
+    async def asummarize_batch(
+        self,
+        text: str,
+        queries: list[str],
+        client: AsyncOpenAI,
+        sem: asyncio.Semaphore,
+        limiter: AsyncLimiter,
+        url: str | None = None,
+    ) -> list[str]:
+        """Answer several questions about the same content in a single chat completion.
+
+        Cached answers are reused. The remaining questions share one request
+        that sends the content and system prompt once; the model returns
+        {"answers": [{"id": int, "answer": str}, ...]}, which is reordered to
+        match ``queries``. A single uncached question goes through
+        asummarize_content.
+        """
+        keys = [self._summary_key(text, q) for q in queries]
+        answers = [self._cached_summary(key, q, url) for key, q in zip(keys, queries)]
+        pending = [i for i, answer in enumerate(answers) if answer is None]
+        if len(pending) == 1:
+            i = pending[0]
+            answers[i] = await self.asummarize_content(text, queries[i], client, sem, limiter, url=url)
+            return answers
+        if not pending:
+            return answers
+
+        numbered = "\n".join(f"{n}. {queries[i]}" for n, i in enumerate(pending, start=1))
+        system_prompt, user_prompt = SYSTEM_PROMPT, _BATCH_TEMPLATE.format(text=text, questions=numbered)
+        kwargs = self._completion_kwargs(system_prompt, user_prompt)
+        # The batch always answers in JSON, with the usual completion allowance per question
+        kwargs.update(max_tokens=_MAX_TOKENS * len(pending), response_format={"type": "json_object"})
+
+        async def _call_openai_and_parse() -> tuple[list[str], list[str]]:
+            resp = await self._acreate_completion(client, sem, limiter, **kwargs)
+            batch_answers, reasonings = self._parse_batch(resp.choices[0], len(pending))
+            for i, answer in zip(pending, batch_answers):
+                answers[i] = answer
+                self._store_summary(keys[i], answer)
+            return batch_answers, reasonings
+
+        if self.langfuse:
+            with self.langfuse.start_as_current_generation(
+                name="summarize_batch",
+                input={"system": system_prompt, "user": user_prompt},
+                metadata={"url": url, "questions": len(pending), "capture_cot": CAPTURE_COT},
+                model=self.model,
+            ) as gen:
+                batch_answers, reasonings = await _call_openai_and_parse()
+                gen.output = batch_answers
+                self._log_reasoning("\n\n".join(reasonings))
+        else:
+            await _call_openai_and_parse()
+        return answers
+
+    def _response_key(self, url: str, user_input: str) -> str:
+        return _digest(f"{url}|{_normalize_query(user_input)}|{self.model}")
+
+    def _cached_response(self, key: str, url: str, user_input: str) -> Tuple[str, str, str] | None:
+        """Returns a cached (url, scraped, summary) result, if any.
+
+        A hit skips the scrape and summarize spans; only a minimal root span
+        tagged cache=hit is recorded.
+        """
+        result = _RESPONSE_CACHE.get(key)
+        if result is not None and self.langfuse:
+            self.langfuse.start_span(
+                name="web-scraper-respond",
+                input={"query": user_input, "url": url},
+                metadata={"cache": "hit"},
+            ).end()
+            self._flush_langfuse()
+        return result
+
+    def _store_response(self, key: str, result: Tuple[str, str, str]) -> None:
+        # Scrape failures are usually transient and cut-off answers may succeed on retry;
+        # don't pin either for the TTL. Empty scrapes were never summarized, so skip them too.
+        scraped, summary = result[1], result[2]
+        if scraped and not scraped.startswith("Error scraping website") and summary not in _UNCACHED_ANSWERS:
+            _RESPONSE_CACHE.set(key, result, expire=RESPONSE_CACHE_TTL)
+
     def respond(self, user_input: str) -> Tuple[str, str, str]:
-        url = self._extract_first_url(user_input)
+        """Main workflow: extract URL, scrape, summarize, and log to Langfuse."""
+        url = extract_first_url(user_input)
         if not url:
             return ("", "", "Please provide a valid website URL in your query.")
 
-        trace = None
+        key = self._response_key(url, user_input)
+        cached = self._cached_response(key, url, user_input)
+        if cached is not None:
+            return cached
+
+        scraped, summary = "", ""
         if self.langfuse:
-            try:
-                trace = self.langfuse.trace(
-                    name="web-scraper-respond",
-                    input={"query": user_input, "url": url},
-                    tags=["web-scraper", "crewai-agent"],
-                )
-                print("✅ Created Langfuse trace for web-scraper-respond")
-            except Exception as e:
-                print(f"⚠️ Failed to create Langfuse trace: {e}")
-                trace = None
-
-        scraped = self.scrape_website(url)
-        if trace:
-            try:
-                trace.span(name="scrape_website").end(output={"characters": len(scraped)})
-                print("✅ Logged scrape_website span to Langfuse")
-            except Exception as e:
-                print(f"⚠️ Failed to log scrape span: {e}")
+            # Root span with explicit input/output
+            with self.langfuse.start_as_current_span(
+                name="web-scraper-respond",
+            ) as root_span:
+                root_span.input = {"query": user_input, "url": url}
+                # Scrape website
+                with self.langfuse.start_as_current_span(
+                    name="scrape_website",
+                ) as scrape_span:
+                    scrape_span.input = {"url": url}
+                    scraped, token_count = self._fit_to_budget(self.scrape_website(url), user_input)
+                    scrape_span.output = {"characters": len(scraped), "tokens": token_count}
+                    print("✅ Logged scrape_website span to Langfuse")
+
+                # Summarize
+                if scraped:
+                    summary = self.summarize_content(scraped, user_input, url=url)
+                else:
+                    summary = _NO_CONTENT_ANSWER
+                root_span.output = {"summary": summary, "scraped_characters": len(scraped)}
+                print("✅ Logged summarize_content generation to Langfuse")
+
+            self._flush_langfuse()
+        else:
+            scraped, _ = self._fit_to_budget(self.scrape_website(url), user_input)
+            if scraped:
+                summary = self.summarize_content(scraped, user_input, url=url)
+            else:
+                summary = _NO_CONTENT_ANSWER
 
-        summary = self.summarize_content(scraped, user_input, trace=trace, url=url)
+        self._store_response(key, (url, scraped, summary))
         return (url, scraped, summary)
 
+    def respond_stream(self, user_input: str) -> Tuple[str, str, Iterator[str]]:
+        """Like respond, but returns the answer as a token iterator for st.write_stream.
 
-# ---------------- STREAMLIT FRONTEND ----------------
-st.title("🤖 CrewAI Web Scraper & Summarizer")
-st.caption("Enter a URL and a question. The agent will scrape and summarize content.")
-
-with st.sidebar:
-    st.header("Settings")
-    api_key = st.text_input("OpenAI API Key", value=os.getenv("OPENAI_API_KEY", ""), type="password")
-    model = st.text_input("Model", value=os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
-    st.markdown("Note: API key is used only client-side to initialize the agent.")
+        Spans are opened explicitly rather than as the current context because
+        the summary is produced lazily, after this method has returned.
+        """
+        url = extract_first_url(user_input)
+        if not url:
+            return ("", "", iter(["Please provide a valid website URL in your query."]))
 
-query = st.text_area(
-    "Your prompt (include at least one https:// URL)",
-    height=120,
-    placeholder="Example: Summarize the key points from https://www.bbc.com/news/technology",
-)
+        key = self._response_key(url, user_input)
+        cached = self._cached_response(key, url, user_input)
+        if cached is not None:
+            return (cached[0], cached[1], iter([cached[2]]))
 
-if st.button("Run Agent", type="primary"):
-    if not api_key:
-        st.error("Please provide your OpenAI API key.")
-        st.stop()
+        if not self.langfuse:
+            scraped, _ = self._fit_to_budget(self.scrape_website(url), user_input)
+            if not scraped:
+                return (url, scraped, iter([_NO_CONTENT_ANSWER]))
 
-    os.environ["OPENAI_API_KEY"] = api_key
-    os.environ["OPENAI_MODEL"] = model
+            def _plain_tokens() -> Iterator[str]:
+                buffer: list[str] = []
+                for token in self.summarize_stream(scraped, user_input, url=url):
+                    buffer.append(token)
+                    yield token
+                self._store_response(key, (url, scraped, "".join(buffer)))
 
-    try:
-        agent = WebScraperCrewAgent(model=model)
-    except Exception as exc:
-        st.error(f"Failed to init agent: {exc}")
-        st.stop()
+            return (url, scraped, _plain_tokens())
 
-    with st.spinner("Scraping and summarizing..."):
-        url, scraped, summary = agent.respond(query)
+        root_span = self.langfuse.start_span(
+            name="web-scraper-respond", input={"query": user_input, "url": url}
+        )
+        scrape_span = root_span.start_span(name="scrape_website", input={"url": url})
+        try:
+            scraped, token_count = self._fit_to_budget(self.scrape_website(url), user_input)
+        except Exception:
+            # The token generator below never runs, so close both spans here
+            scrape_span.end()
+            root_span.end()
+            raise
+        scrape_span.update(output={"characters": len(scraped), "tokens": token_count})
+        scrape_span.end()
+
+        def _tokens() -> Iterator[str]:
+            buffer: list[str] = []
+            try:
+                if scraped:
+                    tokens = self.summarize_stream(scraped, user_input, url=url, parent=root_span)
+                else:
+                    tokens = iter([_NO_CONTENT_ANSWER])
+                for token in tokens:
+                    buffer.append(token)
+                    yield token
+                self._store_response(key, (url, scraped, "".join(buffer)))
+            finally:
+                root_span.update(output={"summary": "".join(buffer), "scraped_characters": len(scraped)})
+                root_span.end()
+                self._flush_langfuse()
+
+        return (url, scraped, _tokens())
+
+    async def arespond(
+        self,
+        user_input: str,
+        session: aiohttp.ClientSession,
+        client: AsyncOpenAI,
+        sem: asyncio.Semaphore,
+        limiter: AsyncLimiter,
+    ) -> Tuple[str, str, str]:
+        """Async variant of respond; the caller owns the HTTP session, OpenAI client and limits."""
+        url = extract_first_url(user_input)
+        if not url:
+            return ("", "", "Please provide a valid website URL in your query.")
 
-    col1, col2 = st.columns([1, 1])
+        key = self._response_key(url, user_input)
+        cached = self._cached_response(key, url, user_input)
+        if cached is not None:
+            return cached
 
-    with col1:
-        st.subheader("URL")
-        st.write(url or "(none)")
-        st.subheader("Scraped Content (truncated)")
-        st.code(scraped or "(no content)", language="markdown")
+        scraped, summary = "", ""
+        if self.langfuse:
+            with self.langfuse.start_as_current_span(
+                name="web-scraper-respond",
+            ) as root_span:
+                root_span.input = {"query": user_input, "url": url}
+                with self.langfuse.start_as_current_span(
+                    name="scrape_website",
+                ) as scrape_span:
+                    scrape_span.input = {"url": url}
+                    scraped, token_count = self._fit_to_budget(
+                        await self.ascrape_website(url, session), user_input
+                    )
+                    scrape_span.output = {"characters": len(scraped), "tokens": token_count}
+
+                if scraped:
+                    summary = await self.asummarize_content(scraped, user_input, client, sem, limiter, url=url)
+                else:
+                    summary = _NO_CONTENT_ANSWER
+                root_span.output = {"summary": summary, "scraped_characters": len(scraped)}
+        else:
+            scraped, _ = self._fit_to_budget(await self.ascrape_website(url, session), user_input)
+            if scraped:
+                summary = await self.asummarize_content(scraped, user_input, client, sem, limiter, url=url)
+            else:
+                summary = _NO_CONTENT_ANSWER
 
-    with col2:
-        st.subheader("Answer")
-        st.write(summary)
+        self._store_response(key, (url, scraped, summary))
+        return (url, scraped, summary)
 
-st.markdown("---")
-st.markdown(
-    textwrap.dedent(
-        """
-        Tips:
-        - Provide a full URL beginning with https://  
-        - Add a specific question to focus the summary  
-        - Content is truncated to avoid exceeding token limits
+    async def arespond_many(
+        self,
+        url: str,
+        user_inputs: list[str],
+        session: aiohttp.ClientSession,
+        client: AsyncOpenAI,
+        sem: asyncio.Semaphore,
+        limiter: AsyncLimiter,
+    ) -> list[Tuple[str, str, str]]:
+        """Async respond for several prompts about the same URL: one scrape and one batched completion."""
+        keys = [self._response_key(url, x) for x in user_inputs]
+        results = [self._cached_response(key, url, x) for key, x in zip(keys, user_inputs)]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+
+        queries = [user_inputs[i] for i in pending]
+        # Budget against all the questions, since they share the prompt
+        questions = "\n".join(queries)
+        scraped, summaries = "", []
+        if self.langfuse:
+            with self.langfuse.start_as_current_span(
+                name="web-scraper-respond",
+            ) as root_span:
+                root_span.input = {"queries": queries, "url": url}
+                with self.langfuse.start_as_current_span(
+                    name="scrape_website",
+                ) as scrape_span:
+                    scrape_span.input = {"url": url}
+                    scraped, token_count = self._fit_to_budget(
+                        await self.ascrape_website(url, session), questions
+                    )
+                    scrape_span.output = {"characters": len(scraped), "tokens": token_count}
+
+                if scraped:
+                    summaries = await self.asummarize_batch(scraped, queries, client, sem, limiter, url=url)
+                else:
+                    summaries = [_NO_CONTENT_ANSWER] * len(queries)
+                root_span.output = {"summaries": summaries, "scraped_characters": len(scraped)}
+        else:
+            scraped, _ = self._fit_to_budget(await self.ascrape_website(url, session), questions)
+            if scraped:
+                summaries = await self.asummarize_batch(scraped, queries, client, sem, limiter, url=url)
+            else:
+                summaries = [_NO_CONTENT_ANSWER] * len(queries)
+
+        for i, summary in zip(pending, summaries):
+            results[i] = (url, scraped, summary)
+            self._store_response(keys[i], results[i])
+        return results
+
+    async def respond_batch(self, inputs: list[str]) -> list[Tuple[str, str, str]]:
+        """Run several prompts concurrently; results are returned in input order."""
+        results: list[Tuple[str, str, str]] = [("", "", "")] * len(inputs)
+        async for i, result in self.respond_as_completed(inputs):
+            results[i] = result
+        return results
+
+    async def respond_as_completed(self, inputs: list[str]) -> AsyncIterator[tuple[int, Tuple[str, str, str]]]:
+        """Run several prompts concurrently, yielding (index, result) as each one finishes.
+
+        Scrapes and LLM calls of different prompts overlap, and callers can
+        show a fast page without waiting for the slowest one. Prompts about the
+        same URL share one scrape and one batched completion. The aiohttp
+        session, AsyncOpenAI client, concurrency semaphore and RPM limiter are
+        bound to the running event loop, so they are created per batch and
+        shared by its prompts; OPENAI_MAX_CONCURRENCY and OPENAI_RPM therefore
+        apply per batch, not across concurrent sessions.
         """
-    )
-)
+        import aiohttp
+        from openai import AsyncOpenAI
+
+        sem = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+        # Smooth requests per minute into a per-second leaky bucket
+        limiter = AsyncLimiter(max(OPENAI_RPM / 60, 1), time_period=1)
+        connector = aiohttp.TCPConnector(limit=32)
+        async with aiohttp.ClientSession(connector=connector, headers=_HEADERS) as session:
+            async with AsyncOpenAI(api_key=self.api_key) as client:
+
+                groups: dict[str | None, list[int]] = {}
+                for i, user_input in enumerate(inputs):
+                    groups.setdefault(extract_first_url(user_input), []).append(i)
+
+                async def _run_group(
+                    url: str | None, indices: list[int]
+                ) -> list[tuple[int, Tuple[str, str, str]]]:
+                    if url is None or len(indices) == 1:
+                        return [
+                            (i, await self.arespond(inputs[i], session, client, sem, limiter)) for i in indices
+                        ]
+                    results = await self.arespond_many(
+                        url, [inputs[i] for i in indices], session, client, sem, limiter
+                    )
+                    return list(zip(indices, results))
+
+                tasks = [asyncio.ensure_future(_run_group(url, indices)) for url, indices in groups.items()]
+                try:
+                    for next_done in asyncio.as_completed(tasks):
+                        for indexed in await next_done:
+                            yield indexed
+                finally:
+                    # The consumer may stop early; don't leave requests running on a closed session
+                    for task in tasks:
+                        task.cancel()
+                    # Let cancelled tasks unwind before the session and client close under them
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    if self.langfuse:
+                        self._flush_langfuse()